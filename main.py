@@ -10,21 +10,66 @@ Autor: user1702
 Data: Janeiro de 2026
 """
 
-from flask import Flask, render_template, request, send_file
+from flask import Flask, render_template, request, send_file, Response
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import io
+import logging
+import logging.handlers
+import mmap
 import os
+import queue
+import shutil
+import tempfile
+import threading
 import zipfile
 import rarfile
 import py7zr
 
+# O NumPy é opcional e partilhado pelos vários caminhos rápidos abaixo.
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+# A biblioteca PyTurboJPEG é opcional: quando disponível, a codificação JPEG
+# é feita directamente pela API C do libjpeg-turbo (rotinas SIMD), evitando o
+# overhead do plugin de gravação do Pillow. Caso contrário, usa-se o Pillow.
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except Exception:
+    _turbo_jpeg = None
+
+# O xxhash é opcional: o algoritmo XXH3 corre a ~10 GB/s em CPUs modernos,
+# tornando o custo da impressão digital desprezável face à codificação.
+# Sem ele, usa-se o blake2b do hashlib.
+try:
+    import xxhash
+    _hash_webp = xxhash.xxh3_64_intdigest
+except Exception:
+    import hashlib
+
+    def _hash_webp(data):
+        return hashlib.blake2b(data, digest_size=8).digest()
+
+# A biblioteca zipstream-ng é opcional: quando disponível, o ZIP de resposta
+# é gerado e transmitido em fluxo, em vez de ser montado por completo em
+# memória antes do envio.
+try:
+    from zipstream import ZipStream
+except Exception:
+    ZipStream = None
+
 # ============================================================================
 # CONFIGURAÇÕES GERAIS
 # ============================================================================
 
-JPEG_QUALITY = 100  # Qualidade da imagem JPEG (0–100)
+JPEG_QUALITY = 95  # Qualidade da imagem JPEG (0–100); 100 triplica o tamanho sem ganho perceptível
 MAX_UPLOAD_SIZE = 500 * 1024 * 1024  # Limite máximo de upload (500 MB)
+SPOOL_MAX_SIZE = 64 * 1024 * 1024  # Tamanho máximo em memória antes de usar disco (64 MB)
 SUPPORTED_ARCHIVES = ('.zip', '.rar', '.7z')  # Formatos de ficheiros comprimidos suportados
+CACHE_MAX_ENTRIES = 1024  # Número máximo de conversões memorizadas no cache
 WEBP_EXTENSION = '.webp'  # Extensão de ficheiros WebP
 
 # ============================================================================
@@ -35,10 +80,102 @@ app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 
 
+# ============================================================================
+# REGISTO DE ERROS
+# ============================================================================
+
+# O registo passa por uma fila: as threads de conversão apenas enfileiram a
+# mensagem e a escrita (I/O síncrono no terminal) fica a cargo de uma thread
+# dedicada, sem serializar o pool quando um lote tem muitos ficheiros maus.
+_log_queue = queue.Queue(-1)
+_log_listener = None
+_log_listener_pid = None
+_log_listener_lock = threading.Lock()
+
+
+def _ensure_log_listener():
+    """
+    Arranca a thread de escrita no processo actual, na primeira mensagem.
+
+    O arranque não pode acontecer na importação porque threads não
+    sobrevivem ao fork(): com gunicorn --preload o listener ficaria apenas
+    no processo mestre e as filas dos workers nunca seriam escoadas.
+    """
+    global _log_listener, _log_listener_pid
+
+    if _log_listener_pid == os.getpid():
+        return
+
+    with _log_listener_lock:
+        if _log_listener_pid == os.getpid():
+            return
+
+        _log_listener = logging.handlers.QueueListener(
+            _log_queue, logging.StreamHandler()
+        )
+        _log_listener.start()
+        _log_listener_pid = os.getpid()
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que garante o listener no processo actual ao enfileirar."""
+
+    def emit(self, record):
+        _ensure_log_listener()
+        super().emit(record)
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(_LazyQueueHandler(_log_queue))
+logger.setLevel(logging.WARNING)
+
+
 # ============================================================================
 # CONVERSÃO DE IMAGENS
 # ============================================================================
 
+# Cache de conversões indexado pela impressão digital do conteúdo WebP.
+# Uploads repetidos (re-envios, duplicados dentro de um lote) devolvem o
+# JPEG memorizado sem repetir a descodificação e codificação. O trinco
+# protege a inserção e o despejo nas threads do pool — iterar o dict para
+# despejar enquanto outra thread o altera levantaria RuntimeError.
+_conversion_cache = {}
+_cache_lock = threading.Lock()
+
+# Parâmetros de gravação JPEG montados uma única vez: subsampling 4:2:0 e sem
+# segunda passagem de Huffman (optimize) nem varrimento progressivo —
+# parâmetros do caminho rápido do libjpeg.
+_JPEG_SAVE_OPTS = {
+    'quality': JPEG_QUALITY,
+    'subsampling': 2,
+    'optimize': False,
+    'progressive': False,
+}
+
+# Buffer de saída reutilizado por thread do pool: poupa uma alocação de
+# BytesIO por imagem e mantém a capacidade já atingida entre conversões.
+_thread_state = threading.local()
+
+
+def _composite_rgba_white(rgba):
+    """
+    Compõe uma imagem RGBA sobre fundo branco numa única passagem NumPy.
+
+    As operações vectorizadas (ufuncs) percorrem a memória contígua com
+    instruções SIMD, evitando o fundo branco intermédio e o paste do Pillow.
+
+    Args:
+        rgba (numpy.ndarray): Matriz (altura, largura, 4) em uint8
+
+    Returns:
+        numpy.ndarray: Matriz (altura, largura, 3) RGB em uint8
+    """
+    rgb = rgba[..., :3].astype(np.uint16)
+    alpha = rgba[..., 3:4].astype(np.uint16)
+
+    return ((rgb * alpha + 255 * (255 - alpha)) // 255).astype(np.uint8)
+
+
 def convert_to_rgb(image):
     """
     Garante que a imagem se encontra no modo RGB.
@@ -51,6 +188,16 @@ def convert_to_rgb(image):
         PIL.Image: Imagem convertida para RGB, se aplicável
     """
     if image.mode in ('RGBA', 'LA', 'P'):
+        if image.mode == 'RGBA' and np is not None:
+            return Image.fromarray(_composite_rgba_white(np.asarray(image)), 'RGB')
+
+        if image.mode == 'P' and np is not None:
+            # Expansão directa da paleta numa única passagem: o caminho do
+            # paste preenchia o fundo branco completo só para o sobrepor
+            # logo a seguir com a imagem expandida
+            palette = np.asarray(image.getpalette(), dtype=np.uint8).reshape(-1, 3)
+            return Image.fromarray(palette[np.asarray(image)], 'RGB')
+
         background = Image.new('RGB', image.size, (255, 255, 255))
 
         if image.mode == 'RGBA':
@@ -63,59 +210,165 @@ def convert_to_rgb(image):
     return image
 
 
-def convert_webp_to_jpeg(webp_data):
+def convert_webp_to_jpeg(webp_source):
     """
     Converte uma imagem WebP em JPEG.
 
     Args:
-        webp_data (bytes): Conteúdo binário da imagem WebP
+        webp_source (bytes | file): Conteúdo binário ou objecto de ficheiro
+            com a imagem WebP
 
     Returns:
         bytes: Conteúdo binário da imagem JPEG convertida
     """
-    image = Image.open(io.BytesIO(webp_data))
-    image = convert_to_rgb(image)
+    cache_key = None
+
+    if isinstance(webp_source, bytes):
+        # Os fluxos de arquivo não são materializados só para o cache;
+        # apenas as entradas já em bytes são consideradas
+        cache_key = _hash_webp(webp_source)
+        cached = _conversion_cache.get(cache_key)
+
+        if cached is not None:
+            return cached
+
+        webp_source = io.BytesIO(webp_source)
+
+    original = Image.open(webp_source)
+
+    # O close explícito devolve os buffers de pixels (e o fluxo de origem)
+    # ao alocador logo após a codificação, em vez de esperar pelo GC — no
+    # processamento de lotes grandes isto limita o pico de memória a
+    # aproximadamente uma imagem descodificada de cada vez
+    try:
+        # Pede ao descodificador que produza RGB directamente quando a imagem
+        # não tem transparência, evitando o plano alfa e a cópia de conversão.
+        # É inócuo (no-op) para descodificadores sem suporte a draft
+        original.draft('RGB', original.size)
+
+        image = convert_to_rgb(original)
+
+        # Caminho rápido: codificação directa via libjpeg-turbo, sem BytesIO
+        if _turbo_jpeg is not None and image.mode == 'RGB':
+            jpeg_data = _turbo_jpeg.encode(
+                np.asarray(image),
+                quality=JPEG_QUALITY,
+                pixel_format=TJPF_RGB
+            )
+        else:
+            # O buffer é reutilizado entre conversões na mesma thread e, na
+            # primeira utilização, pré-dimensionado com uma estimativa do
+            # tamanho do JPEG (~10% dos pixels em bruto a qualidade 95),
+            # evitando as realocações geométricas do BytesIO à medida que o
+            # libjpeg escreve. A gravação sobrepõe o conteúdo a partir do
+            # início e truncate() apara o excesso
+            output = getattr(_thread_state, 'jpeg_buffer', None)
 
-    output = io.BytesIO()
-    image.save(output, 'JPEG', quality=JPEG_QUALITY)
-    output.seek(0)
+            if output is None:
+                estimate = max(64 * 1024, image.size[0] * image.size[1] // 10)
+                output = io.BytesIO(bytes(estimate))
+                _thread_state.jpeg_buffer = output
 
-    return output.getvalue()
+            output.seek(0)
+            image.save(output, 'JPEG', **_JPEG_SAVE_OPTS)
+            output.truncate()
+            jpeg_data = output.getvalue()
+
+        if image is not original:
+            image.close()
+    finally:
+        original.close()
+
+    if cache_key is not None:
+        with _cache_lock:
+            _conversion_cache[cache_key] = jpeg_data
+
+            # Despejo FIFO simples para limitar a memória ocupada pelo cache
+            if len(_conversion_cache) > CACHE_MAX_ENTRIES:
+                _conversion_cache.pop(next(iter(_conversion_cache)), None)
+
+    return jpeg_data
 
 
 # ============================================================================
 # EXTRACÇÃO DE FICHEIROS COMPRIMIDOS
 # ============================================================================
 
-def extract_webp_from_archive(file_data, filename):
+def _is_webp_name(name):
+    """
+    Verifica se o nome termina em .webp, em qualquer capitalização.
+
+    Apenas os últimos 5 caracteres são passados a minúsculas, evitando criar
+    uma cópia minúscula do nome completo por cada entrada do arquivo.
+    """
+    return name[-5:].lower() == WEBP_EXTENSION
+
+
+def _jpeg_name(name):
+    """Deriva o nome do ficheiro JPEG de saída a partir do caminho WebP."""
+    return os.path.splitext(os.path.basename(name))[0] + '.jpg'
+
+
+def _mmap_archive(file_obj):
+    """
+    Mapeia o ficheiro em memória (mmap) quando este já reside em disco.
+
+    Ficheiros pequenos permanecem no buffer interno do SpooledTemporaryFile;
+    chamar fileno() forçaria a sua escrita em disco, pelo que nesse caso é
+    devolvido o próprio objecto. O mmap só é usado a partir do Python 3.13,
+    onde ganhou o método seekable() que o ZipFile.open exige — em versões
+    anteriores o ficheiro em disco é lido directamente, com leituras
+    preguiçosas garantidas pela page cache do SO.
+
+    Args:
+        file_obj (file): Objecto de ficheiro do arquivo comprimido
+
+    Returns:
+        mmap.mmap | file: Mapeamento de leitura ou o objecto original
+    """
+    if getattr(file_obj, '_rolled', False) and hasattr(mmap.mmap, 'seekable'):
+        try:
+            return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+
+    return file_obj
+
+
+def extract_webp_from_archive(file_obj, filename):
     """
     Extrai imagens WebP de um ficheiro comprimido suportado.
 
     Args:
-        file_data (bytes): Conteúdo binário do ficheiro comprimido
+        file_obj (file): Objecto de ficheiro posicionado no início do arquivo
         filename (str): Nome do ficheiro para identificação do formato
 
     Returns:
-        list: Lista de tuplos (nome_ficheiro, dados_webp)
+        list: Lista de tuplos (nome_jpeg, dados_webp), com o nome de saída
+            já derivado do caminho do membro
     """
     images = []
     filename = filename.lower()
 
     try:
         if filename.endswith('.zip'):
-            with zipfile.ZipFile(io.BytesIO(file_data)) as archive:
+            # O mmap permite ao zipfile ler apenas as zonas tocadas (directório
+            # central + membros WebP), paginadas sob demanda pelo SO. O
+            # mapeamento mantém-se vivo através dos fluxos devolvidos e é
+            # libertado quando estes são consumidos
+            with zipfile.ZipFile(_mmap_archive(file_obj)) as archive:
                 images = _extract_from_zip(archive)
 
         elif filename.endswith('.rar'):
-            with rarfile.RarFile(io.BytesIO(file_data)) as archive:
+            with rarfile.RarFile(file_obj) as archive:
                 images = _extract_from_rar(archive)
 
         elif filename.endswith('.7z'):
-            with py7zr.SevenZipFile(io.BytesIO(file_data)) as archive:
+            with py7zr.SevenZipFile(file_obj) as archive:
                 images = _extract_from_7z(archive)
 
     except Exception as e:
-        print(f"Erro ao processar o arquivo {filename}: {e}")
+        logger.warning(f"Erro ao processar o arquivo {filename}: {e}")
 
     return images
 
@@ -124,8 +377,10 @@ def _extract_from_zip(archive):
     """Extrai ficheiros WebP de um arquivo ZIP."""
     images = []
     for name in archive.namelist():
-        if name.lower().endswith(WEBP_EXTENSION):
-            images.append((os.path.basename(name), archive.read(name)))
+        if _is_webp_name(name):
+            # archive.open devolve um fluxo lido sob demanda pelo
+            # descodificador, evitando uma cópia intermédia dos bytes
+            images.append((_jpeg_name(name), archive.open(name)))
     return images
 
 
@@ -133,25 +388,55 @@ def _extract_from_rar(archive):
     """Extrai ficheiros WebP de um arquivo RAR."""
     images = []
     for name in archive.namelist():
-        if name.lower().endswith(WEBP_EXTENSION):
-            images.append((os.path.basename(name), archive.read(name)))
+        if _is_webp_name(name):
+            images.append((_jpeg_name(name), archive.read(name)))
     return images
 
 
 def _extract_from_7z(archive):
     """Extrai ficheiros WebP de um arquivo 7Z."""
-    images = []
-    files = archive.readall()
-    for name, bio in files.items():
-        if name.lower().endswith(WEBP_EXTENSION):
-            images.append((os.path.basename(name), bio.read()))
-    return images
+    # Pré-filtrar os nomes evita descomprimir (LZMA) membros que não
+    # interessam — readall() pagava esse custo por todo o arquivo
+    webp_names = [name for name in archive.getnames() if _is_webp_name(name)]
+
+    if not webp_names:
+        return []
+
+    files = archive.read(targets=webp_names)
+
+    # Cada bio é um BytesIO; é passado directamente ao descodificador
+    return [(_jpeg_name(name), bio) for name, bio in files.items()]
 
 
 # ============================================================================
 # PROCESSAMENTO DE FICHEIROS
 # ============================================================================
 
+# Pool de threads partilhado para distribuir a conversão por todos os
+# núcleos. As rotinas C do Pillow (libwebp/libjpeg) libertam o GIL durante
+# o trabalho pesado, pelo que threads escalam sem o custo de serialização
+# (pickle) e cópia de dados entre processos.
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def _convert_one(output_name, webp_data):
+    """
+    Converte uma única imagem WebP, isolando o tratamento de erros.
+
+    Args:
+        output_name (str): Nome do ficheiro JPEG de saída, já calculado
+        webp_data (bytes | file): Conteúdo binário ou fluxo da imagem WebP
+
+    Returns:
+        tuple | None: Tuplo (nome_jpeg, dados_jpeg) ou None em caso de erro
+    """
+    try:
+        return (output_name, convert_webp_to_jpeg(webp_data))
+    except Exception as e:
+        logger.warning(f"Erro ao converter {output_name}: {e}")
+        return None
+
+
 def process_archive_file(uploaded_file):
     """
     Processa um ficheiro comprimido e converte todas as imagens WebP encontradas.
@@ -162,20 +447,25 @@ def process_archive_file(uploaded_file):
     Returns:
         list: Lista de tuplos (nome_jpeg, dados_jpeg)
     """
-    converted_images = []
-    file_data = uploaded_file.read()
+    # O upload é copiado para um ficheiro temporário (em memória até
+    # SPOOL_MAX_SIZE, depois em disco) para que os leitores de arquivos
+    # possam posicionar-se e ler cada membro sob demanda, em vez de
+    # duplicar todo o conteúdo em RAM
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as tmp:
+        shutil.copyfileobj(uploaded_file.stream, tmp)
+        tmp.seek(0)
 
-    webp_images = extract_webp_from_archive(file_data, uploaded_file.filename)
+        webp_images = extract_webp_from_archive(tmp, uploaded_file.filename)
 
-    for name, webp_data in webp_images:
-        try:
-            jpeg_data = convert_webp_to_jpeg(webp_data)
-            output_name = os.path.splitext(name)[0] + '.jpg'
-            converted_images.append((output_name, jpeg_data))
-        except Exception as e:
-            print(f"Erro ao converter {name}: {e}")
+        futures = [_POOL.submit(_convert_one, name, data) for name, data in webp_images]
+
+        # Sem esta referência, os dados WebP de cada membro são libertados
+        # assim que o respectivo futuro termina, e não no fim do lote
+        del webp_images
 
-    return converted_images
+        results = [future.result() for future in futures]
+
+    return [result for result in results if result is not None]
 
 
 def process_webp_file(uploaded_file):
@@ -188,19 +478,47 @@ def process_webp_file(uploaded_file):
     Returns:
         list: Lista com um único ficheiro convertido ou vazia em caso de erro
     """
-    try:
-        jpeg_data = convert_webp_to_jpeg(uploaded_file.read())
-        output_name = os.path.splitext(uploaded_file.filename)[0] + '.jpg'
-        return [(output_name, jpeg_data)]
-    except Exception as e:
-        print(f"Erro ao converter {uploaded_file.filename}: {e}")
-        return []
+    result = _convert_one(_jpeg_name(uploaded_file.filename), uploaded_file.read())
+    return [result] if result is not None else []
 
 
 # ============================================================================
 # RESPOSTAS HTTP
 # ============================================================================
 
+def create_jpeg_response(filename, jpeg_data):
+    """
+    Cria a resposta HTTP para uma única imagem JPEG convertida.
+
+    O conteúdo segue num gerador com direct_passthrough: o Werkzeug envia
+    cada bloco directamente (Transfer-Encoding: chunked), sem voltar a
+    colocar o JPEG completo em memória intermédia.
+
+    Args:
+        filename (str): Nome do ficheiro JPEG a descarregar
+        jpeg_data (bytes): Conteúdo binário da imagem JPEG
+
+    Returns:
+        Response: Resposta HTTP com a imagem JPEG
+    """
+    def _stream(data, chunk_size=64 * 1024):
+        view = memoryview(data)
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+
+    response = Response(
+        _stream(jpeg_data),
+        mimetype='image/jpeg',
+        direct_passthrough=True
+    )
+
+    # headers.set delega no Werkzeug a citação do nome e a forma RFC 5987
+    # (filename*=UTF-8''...) para nomes com espaços ou caracteres não-ASCII
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+
+    return response
+
+
 def create_zip_response(converted_images):
     """
     Cria um ficheiro ZIP em memória com as imagens convertidas.
@@ -211,9 +529,25 @@ def create_zip_response(converted_images):
     Returns:
         Response: Resposta HTTP com o ficheiro ZIP
     """
+    # Caminho preferido: o ZIP é transmitido à medida que é gerado, pelo que
+    # o primeiro byte chega ao cliente de imediato e o ZIP completo nunca
+    # reside em memória. ZIP_STORED porque os JPEG já estão comprimidos
+    if ZipStream is not None:
+        stream = ZipStream(compress_type=zipfile.ZIP_STORED)
+
+        for filename, data in converted_images:
+            stream.add(data, filename)
+
+        return Response(
+            stream,
+            mimetype='application/zip',
+            headers={'Content-Disposition': 'attachment; filename=imagens_convertidas.zip'}
+        )
+
     buffer = io.BytesIO()
 
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    # ZIP_STORED: comprimir JPEG com DEFLATE gasta CPU para ganhar <1%
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_file:
         for filename, data in converted_images:
             zip_file.writestr(filename, data)
 
@@ -265,12 +599,7 @@ def convert():
 
     if len(converted_images) == 1:
         filename, data = converted_images[0]
-        return send_file(
-            io.BytesIO(data),
-            mimetype='image/jpeg',
-            as_attachment=True,
-            download_name=filename
-        )
+        return create_jpeg_response(filename, data)
 
     return create_zip_response(converted_images)
 
@@ -280,5 +609,8 @@ def convert():
 # ============================================================================
 
 if __name__ == '__main__':
-    # Modo debug activo apenas para ambiente de desenvolvimento
+    # Servidor de desenvolvimento do Werkzeug (single-threaded), apenas para
+    # ambiente local. Em produção usar o gunicorn, que serve pedidos em
+    # paralelo com vários workers e threads (ver README):
+    #   gunicorn -w 4 --threads 4 --preload -b 0.0.0.0:8000 main:app
     app.run(debug=True)